@@ -3,7 +3,6 @@
 # optionally runs tools (search_hotels, book_room, etc.), returns text + ui_action.
 # =============================================================================
 
-import os
 import json
 import sys
 # Load .env so we can read OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_MODEL_NAME
@@ -11,8 +10,8 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-# OpenAI client (works with OpenAI, Groq, or any compatible API when base_url is set)
-from openai import OpenAI
+# LLM client with timeouts, retries, hedging and fallback endpoints (OpenAI-compatible)
+from llm_client import ResilientLLMClient, LLMUnavailableError
 # All tools the agent can call (implemented in tools.py)
 from tools import search_hotels, show_hotel_details, book_room, cancel_reservation, modify_reservation, recommend_activities
 
@@ -21,13 +20,10 @@ class HotelConciergeAgent:
     """Agent that uses an LLM and a set of tools to handle hotel search and booking."""
 
     def __init__(self, history=None):
-        # Create API client: key and optional base_url (e.g. for Groq or local LLM)
-        self.client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            base_url=os.getenv("OPENAI_BASE_URL")  # Optional: for Groq, LocalAI, etc.
-        )
-        # Model name (e.g. gpt-4o, or provider-specific)
-        self.model_name = os.getenv("OPENAI_MODEL_NAME", "gpt-4o")
+        # Create API client from .env: primary endpoint (OPENAI_BASE_URL, e.g. Groq) plus
+        # optional fallbacks (OPENAI_FALLBACK_BASE_URL, e.g. a local LLM)
+        # (each endpoint has its own model; OPENAI_MODEL_NAME for the primary)
+        self.client = ResilientLLMClient.from_env()
 
         # Load system prompt from file (instructions for the LLM)
         with open("system_prompt.md", "r", encoding="utf-8") as f:
@@ -138,12 +134,15 @@ class HotelConciergeAgent:
 
         # Step 1: Call LLM with tools; it may return text only or request tool calls
         try:
-            completion = self.client.chat.completions.create(
-                model=self.model_name,
+            completion = self.client.create(
                 messages=self.messages,
                 tools=self.tools,
                 tool_choice="auto"  # Let the model decide whether to call tools
             )
+        except LLMUnavailableError as e:
+            # Every endpoint timed out or failed: answer instead of hanging the request
+            print(f"[ERROR] LLM unavailable: {e}", file=sys.stderr)
+            return {"text": "I'm having trouble reaching my assistant service right now. Please try again in a moment."}
         except Exception as e:
             # Handle provider-specific errors (e.g. Groq tool_use_failed)
             if "tool_use_failed" in str(e):
@@ -224,8 +223,7 @@ class HotelConciergeAgent:
 
         # Step 4: Call LLM again with tool results to get final natural-language reply
         try:
-            final_completion = self.client.chat.completions.create(
-                model=self.model_name,
+            final_completion = self.client.create(
                 messages=self.messages,
                 tools=self.tools,
                 tool_choice="none"  # Do not allow more tool calls; just summarize
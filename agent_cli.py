@@ -1,47 +1,273 @@
 # =============================================================================
 # Agent CLI: entry point called by api.php. Loads session, runs the agent,
 # saves session, and prints the JSON response to stdout for PHP to capture.
+# Turns for one session run one at a time (lease on the sessions row), and a
+# duplicate message sent while the same message is in flight reuses its reply.
 # =============================================================================
 
 import argparse
 import json
+import os
 import sqlite3
 import sys
+import time
+import uuid
 # Import the main agent class that talks to the LLM and runs tools
 from agent import HotelConciergeAgent
 
+# A turn makes at most two LLM calls (tools, then final answer), each bounded by
+# LLM_DEADLINE_SECONDS (see llm_client.py); the margin covers tools and SQLite
+LLM_CALLS_PER_TURN = 2
+LEASE_MARGIN_SECONDS = 60
+# How long one turn may hold the session before another process may take over
+LEASE_SECONDS = LLM_CALLS_PER_TURN * float(os.getenv("LLM_DEADLINE_SECONDS", "45")) + LEASE_MARGIN_SECONDS
+# Delay between two checks of the session row while waiting
+POLL_SECONDS = 0.25
+# How long a process waits for the session to become free before giving up: one
+# full lease, so the turn ahead of us either finishes or its lease expires and we
+# take over. Only a message queued behind two or more turns can still get BUSY.
+WAIT_SECONDS = LEASE_SECONDS + 4 * POLL_SECONDS
+# How many times a save is retried after a version conflict
+SAVE_ATTEMPTS = 5
+# Reply when we could not get the session (still locked, or the database was busy)
+BUSY_RESPONSE = {"text": "I'm still working on your previous message. Please try again in a moment."}
+
+# Columns added to the original sessions table (name -> SQL type)
+SESSION_COLUMNS = {
+    "version": "INTEGER NOT NULL DEFAULT 0",
+    "lease_until": "REAL",
+    "lease_owner": "TEXT",
+    "inflight_message": "TEXT",
+    "last_message": "TEXT",
+    "last_response": "TEXT",
+}
+
+
+# Set once the sessions table has been checked in this process
+_columns_checked = False
+
+
+class SessionConflictError(Exception):
+    """Raised when the session row changed since we loaded it (version mismatch)."""
+
+
+def get_connection():
+    """Open hotel_agent.db in autocommit mode so we can control transactions ourselves."""
+    global _columns_checked
+    conn = sqlite3.connect("hotel_agent.db", timeout=10, isolation_level=None)
+    if not _columns_checked:
+        try:
+            ensure_session_columns(conn)
+        except Exception:
+            conn.close()
+            raise
+        _columns_checked = True
+    return conn
+
+
+def ensure_session_columns(conn):
+    """Add the locking/versioning columns to an existing sessions table if missing."""
+    # Take the write lock first so concurrent first requests do not both run ALTER
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+        for name, sql_type in SESSION_COLUMNS.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE sessions ADD COLUMN {name} {sql_type}")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
 
 def load_session(session_id):
-    """Load conversation history and state for this session from SQLite."""
-    # Open the database file (same one used for reservations)
-    conn = sqlite3.connect("hotel_agent.db")
-    cursor = conn.cursor()
-    # context = serialized message list; state = e.g. IDLE or RUNNING
-    cursor.execute("SELECT context, state FROM sessions WHERE session_id = ?", (session_id,))
-    row = cursor.fetchone()
+    """Load conversation history and version for this session from SQLite."""
+    conn = get_connection()
+    # context = serialized message list; version = save counter
+    row = conn.execute(
+        "SELECT context, version FROM sessions WHERE session_id = ?", (session_id,)
+    ).fetchone()
     conn.close()
 
     if row:
-        # Return parsed JSON context (list of messages) and state string
-        return json.loads(row[0]), row[1]
-    # No session yet: return empty dict and IDLE
-    return {}, "IDLE"
-
-
-def save_session(session_id, context, state):
-    """Save conversation history and state for this session to SQLite."""
-    conn = sqlite3.connect("hotel_agent.db")
-    cursor = conn.cursor()
-    # Upsert: insert or update by session_id (context is JSON string of messages)
-    cursor.execute("""
-    INSERT INTO sessions (session_id, context, state)
-    VALUES (?, ?, ?)
-    ON CONFLICT(session_id) DO UPDATE SET
-        context=excluded.context,
-        state=excluded.state
-    """, (session_id, json.dumps(context), state))
-    conn.commit()
+        # Return parsed JSON context (list of messages) and version
+        return json.loads(row[0] or "{}"), row[1]
+    # No session yet: return empty dict and version 0
+    return {}, 0
+
+
+def acquire_session(session_id, message):
+    """
+    Take the lease on this session so no other turn runs at the same time.
+    Returns (status, owner, response): ("ACQUIRED", owner, None) when we own the
+    session (owner = token to pass to save/release), ("COALESCED", None, response)
+    when an identical in-flight message already produced a reply, or
+    ("BUSY", None, None) if the session stayed locked for WAIT_SECONDS.
+    """
+    owner = uuid.uuid4().hex
+    deadline = time.time() + WAIT_SECONDS
+    waiting_for = None  # version we are waiting to see finish (coalescing)
+
+    while time.time() < deadline:
+        conn = get_connection()
+        try:
+            now = time.time()
+            # BEGIN IMMEDIATE takes the write lock, so the read + update below is atomic
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT state, version, lease_until, inflight_message, last_message, last_response "
+                "FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+
+            if row:
+                state, version, lease_until, inflight_message, last_message, last_response = row
+            else:
+                state, version, lease_until, inflight_message = "IDLE", 0, None, None
+                last_message, last_response = None, None
+
+            # Our identical message finished while we were waiting: reuse its reply
+            if waiting_for is not None and version > waiting_for and last_message == message:
+                conn.execute("COMMIT")
+                return "COALESCED", None, json.loads(last_response)
+
+            # Legacy rows have state RUNNING without a lease; only a live lease blocks us
+            locked = state == "RUNNING" and lease_until is not None and lease_until > now
+
+            if not locked:
+                # Free (or lease expired): claim it for this turn
+                conn.execute("""
+                INSERT INTO sessions (session_id, context, state, version, lease_until, lease_owner, inflight_message)
+                VALUES (?, ?, 'RUNNING', 0, ?, ?, ?)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    state='RUNNING',
+                    lease_until=excluded.lease_until,
+                    lease_owner=excluded.lease_owner,
+                    inflight_message=excluded.inflight_message
+                """, (session_id, json.dumps({}), now + LEASE_SECONDS, owner, message))
+                conn.execute("COMMIT")
+                return "ACQUIRED", owner, None
+
+            # Same message already in flight (double-click, second tab): wait for its reply
+            if waiting_for is None and inflight_message == message:
+                waiting_for = version
+
+            conn.execute("COMMIT")
+        except Exception:
+            # e.g. "database is locked": do not leave the transaction open
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        time.sleep(POLL_SECONDS)
+
+    return "BUSY", None, None
+
+
+def release_session(session_id, owner):
+    """Drop our lease without saving (used when the turn failed)."""
+    conn = get_connection()
+    # Only if we still own it: an expired lease may already belong to another process
+    conn.execute(
+        "UPDATE sessions SET state='IDLE', lease_until=NULL, lease_owner=NULL, inflight_message=NULL "
+        "WHERE session_id = ? AND lease_owner = ?",
+        (session_id, owner)
+    )
+    conn.close()
+
+
+def save_session(session_id, context, version, owner, message, response):
+    """
+    Save conversation history for this session, only if nobody saved since we
+    loaded it (optimistic check on version). Also releases the lease if we still
+    own it and keeps the reply so a coalesced duplicate request can return it.
+    """
+    conn = get_connection()
+    # The lease columns are only reset when lease_owner is still ours; a late save
+    # after our lease expired must not free the lease another process now holds
+    cursor = conn.execute("""
+    UPDATE sessions SET
+        context=?,
+        version=version + 1,
+        state=CASE WHEN lease_owner = ? THEN 'IDLE' ELSE state END,
+        lease_until=CASE WHEN lease_owner = ? THEN NULL ELSE lease_until END,
+        inflight_message=CASE WHEN lease_owner = ? THEN NULL ELSE inflight_message END,
+        lease_owner=CASE WHEN lease_owner = ? THEN NULL ELSE lease_owner END,
+        last_message=?,
+        last_response=?
+    WHERE session_id = ? AND version = ?
+    """, (json.dumps(context), owner, owner, owner, owner,
+          message, json.dumps(response), session_id, version))
+    if cursor.rowcount == 0:
+        # The row may have been deleted meanwhile: recreate it (no-op if it exists)
+        cursor = conn.execute("""
+        INSERT INTO sessions (session_id, context, state, version, last_message, last_response)
+        VALUES (?, ?, 'IDLE', 1, ?, ?)
+        ON CONFLICT(session_id) DO NOTHING
+        """, (session_id, json.dumps(context), message, json.dumps(response)))
     conn.close()
+    if cursor.rowcount == 0:
+        raise SessionConflictError(session_id)
+
+
+def save_turn(session_id, history, version, owner, new_messages, message, response):
+    """
+    Persist this turn. If another process saved in between (our lease expired),
+    reload its history and append our new messages instead of overwriting it.
+    Gives up with SessionConflictError after SAVE_ATTEMPTS tries.
+    """
+    context = history + new_messages
+    for _ in range(SAVE_ATTEMPTS):
+        try:
+            save_session(session_id, context, version, owner, message, response)
+            return
+        except SessionConflictError:
+            time.sleep(POLL_SECONDS)
+            latest, version = load_session(session_id)
+            base = latest if isinstance(latest, list) and latest else history
+            context = base + new_messages
+    raise SessionConflictError(session_id)
+
+
+def handle_message(session_id, message):
+    """Run one turn for this session under its lease and return the response dict."""
+    # Wait for our turn on this session (or reuse the reply of an identical in-flight message)
+    try:
+        status, owner, response = acquire_session(session_id, message)
+    except sqlite3.OperationalError as e:
+        # e.g. "database is locked" after the busy timeout: answer instead of printing nothing
+        print(f"[ERROR] Could not lock session {session_id}: {e}", file=sys.stderr)
+        return BUSY_RESPONSE
+    if status == "COALESCED":
+        return response
+    if status == "BUSY":
+        return BUSY_RESPONSE
+
+    try:
+        # Load existing conversation for this session (or empty if new)
+        context, version = load_session(session_id)
+
+        # Context must be a list of messages for the LLM; if legacy dict, ignore it
+        history = None
+        if isinstance(context, list):
+            history = context
+
+        # Create the agent with optional conversation history (system + past messages + tool results)
+        agent = HotelConciergeAgent(history=list(history) if history else None)
+        base_messages = list(agent.messages)
+
+        # Process the new user message: LLM may call tools, we get back { text, ui_action? }
+        response = agent.process_input(message)
+
+        # Persist updated conversation (only the messages added by this turn are new)
+        new_messages = agent.messages[len(base_messages):]
+        save_turn(session_id, base_messages, version, owner, new_messages, message, response)
+    except Exception:
+        # Free the session so the next message is not blocked until the lease expires
+        release_session(session_id, owner)
+        raise
+
+    return response
 
 
 def main():
@@ -51,22 +277,7 @@ def main():
     parser.add_argument("--message", required=True, help="User message")
     args = parser.parse_args()
 
-    # Load existing conversation for this session (or empty if new)
-    context, state = load_session(args.session_id)
-
-    # Context must be a list of messages for the LLM; if legacy dict, ignore it
-    history = None
-    if isinstance(context, list):
-        history = context
-
-    # Create the agent with optional conversation history (system + past messages + tool results)
-    agent = HotelConciergeAgent(history=history)
-
-    # Process the new user message: LLM may call tools, we get back { text, ui_action? }
-    response = agent.process_input(args.message)
-
-    # Persist updated conversation (agent.messages includes the new turn)
-    save_session(args.session_id, agent.messages, "RUNNING")
+    response = handle_message(args.session_id, args.message)
 
     # Print JSON to stdout so PHP shell_exec can capture it and send to frontend
     print(json.dumps(response))
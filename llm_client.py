@@ -0,0 +1,354 @@
+# =============================================================================
+# Resilient LLM client: wraps one or more OpenAI-compatible endpoints with
+# per-call deadlines, jittered exponential retries on transient errors,
+# optional hedged requests and a circuit breaker per endpoint.
+# =============================================================================
+
+import math
+import os
+import queue
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+import openai
+from openai import OpenAI
+
+# HTTP status codes worth retrying (timeout, conflict, rate limit, server errors)
+RETRYABLE_STATUS = {408, 409, 429}
+# Number of latency samples needed before hedging uses the observed p95
+MIN_LATENCY_SAMPLES = 20
+
+
+class LLMUnavailableError(Exception):
+    """Raised when no endpoint produced a completion before the deadline."""
+
+
+def is_transient(error):
+    """Return True if the error is worth retrying (network, timeout, 429, 5xx)."""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+class EndpointStateStore:
+    """
+    Circuit breaker state and latency samples per endpoint, kept in SQLite
+    (hotel_agent.db) so they outlive one agent_cli.py process.
+    """
+
+    def __init__(self, db_path="hotel_agent.db", max_samples=200):
+        self.db_path = db_path
+        self.max_samples = max_samples
+        self._tables_checked = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        if not self._tables_checked:
+            # Same tables as setup_db.py, for databases created before they existed
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_breakers (
+                endpoint TEXT PRIMARY KEY,
+                failures INTEGER NOT NULL DEFAULT 0,
+                opened_at REAL
+            )
+            """)
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_latencies (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                endpoint TEXT,
+                seconds REAL
+            )
+            """)
+            self._tables_checked = True
+        return conn
+
+    def breaker_state(self, endpoint):
+        """Return (failures, opened_at) for the endpoint; (0, None) if never seen."""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT failures, opened_at FROM llm_breakers WHERE endpoint = ?", (endpoint,)
+        ).fetchone()
+        conn.close()
+        return row if row else (0, None)
+
+    def record_success(self, endpoint):
+        conn = self._connect()
+        conn.execute("DELETE FROM llm_breakers WHERE endpoint = ?", (endpoint,))
+        conn.close()
+
+    def record_failure(self, endpoint, failure_threshold):
+        """Count one failure; (re)open the circuit once failure_threshold is reached."""
+        conn = self._connect()
+        # Single statement, so concurrent processes cannot lose an increment
+        conn.execute("""
+        INSERT INTO llm_breakers (endpoint, failures, opened_at)
+        VALUES (?, 1, CASE WHEN 1 >= ? THEN ? END)
+        ON CONFLICT(endpoint) DO UPDATE SET
+            failures=failures + 1,
+            opened_at=CASE WHEN failures + 1 >= ? THEN ? ELSE opened_at END
+        """, (endpoint, failure_threshold, time.time(), failure_threshold, time.time()))
+        conn.close()
+
+    def claim_trial(self, endpoint, reset_seconds):
+        """
+        Atomically let exactly one caller through once the cooldown is over, by
+        restarting the cooldown; everyone else keeps seeing the circuit open.
+        """
+        now = time.time()
+        conn = self._connect()
+        cursor = conn.execute(
+            "UPDATE llm_breakers SET opened_at = ? WHERE endpoint = ? AND opened_at <= ?",
+            (now, endpoint, now - reset_seconds)
+        )
+        conn.close()
+        return cursor.rowcount == 1
+
+    def add_latency(self, endpoint, seconds):
+        """Store one successful call's latency, keeping the newest max_samples."""
+        conn = self._connect()
+        conn.execute("INSERT INTO llm_latencies (endpoint, seconds) VALUES (?, ?)", (endpoint, seconds))
+        conn.execute("""
+        DELETE FROM llm_latencies WHERE endpoint = ? AND id NOT IN (
+            SELECT id FROM llm_latencies WHERE endpoint = ? ORDER BY id DESC LIMIT ?
+        )
+        """, (endpoint, endpoint, self.max_samples))
+        conn.close()
+
+    def latencies(self, endpoint):
+        conn = self._connect()
+        rows = conn.execute("SELECT seconds FROM llm_latencies WHERE endpoint = ?", (endpoint,)).fetchall()
+        conn.close()
+        return [row[0] for row in rows]
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint after repeated failures.
+    Closed: requests pass. Open: requests are skipped for reset_seconds.
+    After that a single trial request is let through (half-open); success
+    closes the circuit, failure reopens it. State lives in an EndpointStateStore.
+    """
+
+    def __init__(self, name, store, failure_threshold=3, reset_seconds=30):
+        self.name = name
+        self.store = store
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+    def available(self):
+        """Return True if the circuit is closed or its cooldown is over (claims nothing)."""
+        _, opened_at = self.store.breaker_state(self.name)
+        return opened_at is None or time.time() - opened_at >= self.reset_seconds
+
+    def allow(self):
+        """
+        Return True if a request may be sent to this endpoint now. Call it only
+        right before sending: in half-open state it uses up the single trial.
+        """
+        _, opened_at = self.store.breaker_state(self.name)
+        if opened_at is None:
+            return True
+        if time.time() - opened_at < self.reset_seconds:
+            return False
+        # Half-open: only the caller that wins the claim sends the trial request
+        return self.store.claim_trial(self.name, self.reset_seconds)
+
+    def record_success(self):
+        self.store.record_success(self.name)
+
+    def record_failure(self):
+        self.store.record_failure(self.name, self.failure_threshold)
+
+
+class Endpoint:
+    """One OpenAI-compatible provider: its client, model name and circuit breaker."""
+
+    def __init__(self, name, client, model, breaker=None):
+        self.name = name
+        self.client = client
+        self.model = model
+        # Created by ResilientLLMClient from its state store when not given
+        self.breaker = breaker
+
+
+class ResilientLLMClient:
+    """Calls chat completions on an ordered list of endpoints, primary first."""
+
+    def __init__(self, endpoints, deadline=45, attempt_timeout=20, max_retries=2,
+                 backoff_base=0.5, backoff_max=8, hedge_after=None, store=None):
+        # Breaker state and latency samples shared with other agent_cli.py processes
+        self.store = store or EndpointStateStore()
+        self.endpoints = endpoints
+        for endpoint in endpoints:
+            if endpoint.breaker is None:
+                endpoint.breaker = CircuitBreaker(endpoint.name, self.store)
+        # Total time budget for one create() call, across retries and fallbacks
+        self.deadline = deadline
+        # Time budget for a single HTTP request
+        self.attempt_timeout = attempt_timeout
+        # Extra rounds over the endpoint list after the first one fails
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Seconds before sending a hedged request (None = hedging disabled);
+        # replaced by the endpoint's observed p95 latency once enough samples exist
+        self.hedge_after = hedge_after
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build the client from .env: OPENAI_API_KEY / OPENAI_BASE_URL / OPENAI_MODEL_NAME
+        for the primary endpoint, OPENAI_FALLBACK_BASE_URL (comma-separated list) with
+        OPENAI_FALLBACK_API_KEY / OPENAI_FALLBACK_MODEL_NAME for fallbacks, and
+        LLM_* variables for timeouts, retries and hedging.
+        """
+        model = os.getenv("OPENAI_MODEL_NAME", "gpt-4o")
+        endpoints = [Endpoint(
+            name=os.getenv("OPENAI_BASE_URL") or "openai",
+            # max_retries=0: retries are handled here, not inside the SDK
+            client=OpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                          base_url=os.getenv("OPENAI_BASE_URL"), max_retries=0),
+            model=model,
+        )]
+        for base_url in os.getenv("OPENAI_FALLBACK_BASE_URL", "").split(","):
+            base_url = base_url.strip()
+            if not base_url:
+                continue
+            endpoints.append(Endpoint(
+                name=base_url,
+                # Local servers usually accept any key
+                client=OpenAI(api_key=os.getenv("OPENAI_FALLBACK_API_KEY") or "not-needed",
+                              base_url=base_url, max_retries=0),
+                model=os.getenv("OPENAI_FALLBACK_MODEL_NAME", model),
+            ))
+
+        hedge_after = os.getenv("LLM_HEDGE_AFTER_SECONDS")
+        return cls(
+            endpoints,
+            deadline=float(os.getenv("LLM_DEADLINE_SECONDS", "45")),
+            attempt_timeout=float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", "20")),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "2")),
+            hedge_after=float(hedge_after) if hedge_after else None,
+        )
+
+    def create(self, **kwargs):
+        """
+        Same arguments as chat.completions.create (without model). Tries endpoints
+        in order; on a transient error moves to the next one, and after a full round
+        waits with jittered exponential backoff. Non-transient errors (e.g. 400
+        tool_use_failed) are raised immediately so the caller can handle them.
+        """
+        deadline_at = time.time() + self.deadline
+        last_error = None
+
+        for attempt in range(self.max_retries + 1):
+            # Filter without claiming: a half-open trial is only used when we really call
+            endpoints = [e for e in self.endpoints if e.breaker.available()]
+            if not endpoints:
+                # Every circuit is open: fail fast instead of waiting on dead providers
+                raise LLMUnavailableError(f"All LLM endpoints are unavailable (circuit open; last error: {last_error})")
+            # Names of endpoints already called this round (directly or as a hedge)
+            tried = set()
+            for i, endpoint in enumerate(endpoints):
+                if endpoint.name in tried:
+                    continue
+                remaining = deadline_at - time.time()
+                if remaining <= 0:
+                    break
+                if not endpoint.breaker.allow():
+                    # Another caller took the half-open trial meanwhile
+                    continue
+                tried.add(endpoint.name)
+                timeout = min(self.attempt_timeout, remaining)
+                # Hedge to the next endpoint not tried yet (or the same one if none is left)
+                later = [e for e in endpoints[i + 1:] if e.name not in tried]
+                backup = later[0] if later else endpoint
+                try:
+                    return self._call_hedged(endpoint, backup, kwargs, timeout, tried)
+                except Exception as e:
+                    if not is_transient(e):
+                        raise
+                    last_error = e
+                    print(f"[WARN] LLM call to {endpoint.name} failed: {e}", file=sys.stderr)
+
+            # Full jitter: sleep a random time up to base * 2^attempt (capped)
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            if attempt == self.max_retries or time.time() + delay >= deadline_at:
+                break
+            time.sleep(delay)
+
+        raise LLMUnavailableError(f"No LLM endpoint answered in time (last error: {last_error})")
+
+    def _call(self, endpoint, kwargs, timeout):
+        """Send one request, recording latency and updating the endpoint's breaker."""
+        start = time.time()
+        try:
+            completion = endpoint.client.chat.completions.create(
+                model=endpoint.model, timeout=timeout, **kwargs
+            )
+        except Exception as e:
+            # Only provider problems count against the breaker, not bad requests
+            if is_transient(e):
+                endpoint.breaker.record_failure()
+            raise
+        endpoint.breaker.record_success()
+        self.store.add_latency(endpoint.name, time.time() - start)
+        return completion
+
+    def _hedge_delay(self, endpoint):
+        """Seconds to wait before hedging: endpoint's observed p95 latency, else hedge_after."""
+        if self.hedge_after is None:
+            return None
+        latencies = self.store.latencies(endpoint.name)
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return self.hedge_after
+        ordered = sorted(latencies)
+        # Nearest-rank p95: smallest sample with at least 95% of samples at or below it
+        return ordered[math.ceil(0.95 * len(ordered)) - 1]
+
+    def _call_hedged(self, endpoint, backup, kwargs, timeout, tried):
+        """
+        Call endpoint; if it has not answered after the hedge delay, send the same
+        request to backup and return whichever succeeds first. A hedged backup is
+        added to tried so create() does not call it again in the same round.
+        """
+        hedge_delay = self._hedge_delay(endpoint)
+        if hedge_delay is None or hedge_delay >= timeout:
+            return self._call(endpoint, kwargs, timeout)
+
+        # Daemon threads: the losing request must not keep the process alive after
+        # we return (api.php waits for agent_cli.py to exit); its timeout bounds it
+        results = queue.Queue()
+
+        def run(target, target_timeout):
+            try:
+                results.put((True, self._call(target, kwargs, target_timeout)))
+            except Exception as e:
+                results.put((False, e))
+
+        threading.Thread(target=run, args=(endpoint, timeout), daemon=True).start()
+        launched = 1
+        try:
+            ok, value = results.get(timeout=hedge_delay)
+        except queue.Empty:
+            # Still waiting after the hedge delay: send the same request to backup,
+            # if its breaker lets us (this is where a half-open trial gets claimed)
+            if backup.breaker.allow():
+                tried.add(backup.name)
+                threading.Thread(target=run, args=(backup, timeout - hedge_delay), daemon=True).start()
+                launched = 2
+            ok, value = results.get()
+
+        # Return the first successful response; raise only if every request failed
+        received = 1
+        while not ok and received < launched:
+            ok, value = results.get()
+            received += 1
+        if ok:
+            return value
+        raise value
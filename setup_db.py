@@ -10,12 +10,20 @@ def setup_database():
     conn = sqlite3.connect("hotel_agent.db")
     cursor = conn.cursor()
 
-    # Table: one row per chat session; context = JSON list of messages, state = IDLE/RUNNING
+    # Table: one row per chat session; context = JSON list of messages, state = IDLE/RUNNING.
+    # version is bumped on every save (optimistic check); lease_until/lease_owner/inflight_message
+    # mark the turn currently running and which process owns it; last_message/last_response let duplicates reuse a reply.
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS sessions (
         session_id TEXT PRIMARY KEY,
         context TEXT,
-        state TEXT
+        state TEXT,
+        version INTEGER NOT NULL DEFAULT 0,
+        lease_until REAL,
+        lease_owner TEXT,
+        inflight_message TEXT,
+        last_message TEXT,
+        last_response TEXT
     )
     """)
 
@@ -33,6 +41,23 @@ def setup_database():
     )
     """)
 
+    # Tables: circuit breaker state and recent latency samples per LLM endpoint,
+    # shared by all agent_cli.py processes (see llm_client.EndpointStateStore)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS llm_breakers (
+        endpoint TEXT PRIMARY KEY,
+        failures INTEGER NOT NULL DEFAULT 0,
+        opened_at REAL
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS llm_latencies (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        endpoint TEXT,
+        seconds REAL
+    )
+    """)
+
     conn.commit()
     conn.close()
     print("Database 'hotel_agent.db' created successfully.")
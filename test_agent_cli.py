@@ -0,0 +1,229 @@
+# =============================================================================
+# Tests for agent_cli.py session locking: per-session lease, coalescing of
+# identical in-flight messages and optimistic version checks on save.
+# Uses a throwaway hotel_agent.db and a stub agent (no LLM calls).
+# Run: python -m pytest -q
+# =============================================================================
+
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import agent_cli
+import setup_db
+
+SYSTEM = {"role": "system", "content": "system"}
+
+
+class FakeAgent:
+    """Stands in for HotelConciergeAgent: records each LLM turn and answers 're:<message>'."""
+
+    calls = []
+    delay = 0.0
+    fail = False
+
+    def __init__(self, history=None):
+        self.messages = history or [dict(SYSTEM)]
+
+    def process_input(self, message):
+        FakeAgent.calls.append(message)
+        time.sleep(FakeAgent.delay)
+        if FakeAgent.fail:
+            raise RuntimeError("LLM failed")
+        self.messages.append({"role": "user", "content": message})
+        self.messages.append({"role": "assistant", "content": "re:" + message})
+        return {"text": "re:" + message}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run agent_cli in tmp_path, so hotel_agent.db there is used (never the real one)."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(agent_cli, "_columns_checked", False)
+    monkeypatch.setattr(agent_cli, "POLL_SECONDS", 0.02)
+    return tmp_path
+
+
+@pytest.fixture
+def db(workdir, monkeypatch):
+    """Fresh database with the current schema and the stub agent in place."""
+    setup_db.setup_database()
+    monkeypatch.setattr(agent_cli, "HotelConciergeAgent", FakeAgent)
+    monkeypatch.setattr(FakeAgent, "calls", [])
+    monkeypatch.setattr(FakeAgent, "delay", 0.0)
+    monkeypatch.setattr(FakeAgent, "fail", False)
+    return workdir / "hotel_agent.db"
+
+
+def contents(session_id):
+    history, _ = agent_cli.load_session(session_id)
+    return [m["content"] for m in history]
+
+
+def lease(session_id):
+    conn = sqlite3.connect("hotel_agent.db")
+    row = conn.execute(
+        "SELECT state, lease_owner FROM sessions WHERE session_id = ?", (session_id,)
+    ).fetchone()
+    conn.close()
+    return row
+
+
+def send_concurrently(session_id, messages, stagger=0.05):
+    """Call handle_message for each message in its own thread; return the replies in order."""
+    replies = [None] * len(messages)
+
+    def run(i, message):
+        replies[i] = agent_cli.handle_message(session_id, message)
+
+    threads = []
+    for i, message in enumerate(messages):
+        thread = threading.Thread(target=run, args=(i, message))
+        thread.start()
+        threads.append(thread)
+        time.sleep(stagger)
+    for thread in threads:
+        thread.join()
+    return replies
+
+
+def test_identical_concurrent_messages_share_one_llm_call(db):
+    FakeAgent.delay = 0.3
+
+    replies = send_concurrently("s", ["hi", "hi"])
+
+    assert FakeAgent.calls == ["hi"]
+    assert replies == [{"text": "re:hi"}, {"text": "re:hi"}]
+    assert contents("s") == ["system", "hi", "re:hi"]
+
+
+def test_different_message_runs_after_the_live_turn(db):
+    FakeAgent.delay = 0.3
+
+    replies = send_concurrently("s", ["first", "second"])
+
+    assert FakeAgent.calls == ["first", "second"]
+    assert replies == [{"text": "re:first"}, {"text": "re:second"}]
+    assert contents("s") == ["system", "first", "re:first", "second", "re:second"]
+    assert lease("s") == ("IDLE", None)
+
+
+def test_expired_lease_is_taken_over_without_losing_messages(db, monkeypatch):
+    monkeypatch.setattr(agent_cli, "LEASE_SECONDS", 0.1)
+    _, stale, _ = agent_cli.acquire_session("s", "first")
+    _, stale_version = agent_cli.load_session("s")
+    time.sleep(0.15)
+
+    # The stale turn overran its lease: another process takes the session over
+    monkeypatch.setattr(agent_cli, "LEASE_SECONDS", 60)
+    status, fresh, _ = agent_cli.acquire_session("s", "second")
+    _, fresh_version = agent_cli.load_session("s")
+    assert status == "ACQUIRED"
+
+    # The stale process finishes late: its turn is saved, the new lease is untouched
+    first_turn = [{"role": "user", "content": "first"}, {"role": "assistant", "content": "re:first"}]
+    agent_cli.save_turn("s", [SYSTEM], stale_version, stale, first_turn, "first", {"text": "re:first"})
+    agent_cli.release_session("s", stale)
+    assert lease("s") == ("RUNNING", fresh)
+
+    # The new owner's save conflicts and is appended after the stale turn
+    second_turn = [{"role": "user", "content": "second"}, {"role": "assistant", "content": "re:second"}]
+    agent_cli.save_turn("s", [SYSTEM], fresh_version, fresh, second_turn, "second", {"text": "re:second"})
+    assert contents("s") == ["system", "first", "re:first", "second", "re:second"]
+    assert lease("s") == ("IDLE", None)
+
+
+def test_failed_turn_releases_the_lease(db):
+    FakeAgent.fail = True
+    with pytest.raises(RuntimeError):
+        agent_cli.handle_message("s", "boom")
+    assert lease("s") == ("IDLE", None)
+
+    FakeAgent.fail = False
+    assert agent_cli.handle_message("s", "again") == {"text": "re:again"}
+
+
+def test_busy_session_gives_up_after_wait_seconds(db, monkeypatch):
+    monkeypatch.setattr(agent_cli, "WAIT_SECONDS", 0.2)
+    agent_cli.acquire_session("s", "long turn")
+
+    assert agent_cli.handle_message("s", "next") == agent_cli.BUSY_RESPONSE
+    assert FakeAgent.calls == []
+
+
+def test_wait_covers_a_full_lease():
+    assert agent_cli.WAIT_SECONDS > agent_cli.LEASE_SECONDS
+
+
+def test_locked_database_returns_busy_reply(db, monkeypatch):
+    def locked(session_id, message):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(agent_cli, "acquire_session", locked)
+    assert agent_cli.handle_message("s", "hi") == agent_cli.BUSY_RESPONSE
+
+
+def test_save_turn_gives_up_after_save_attempts(db, monkeypatch):
+    attempts = []
+
+    def always_conflict(session_id, *args):
+        attempts.append(session_id)
+        raise agent_cli.SessionConflictError(session_id)
+
+    monkeypatch.setattr(agent_cli, "save_session", always_conflict)
+    with pytest.raises(agent_cli.SessionConflictError):
+        agent_cli.save_turn("s", [SYSTEM], 0, "owner", [], "hi", {"text": "re:hi"})
+    assert len(attempts) == agent_cli.SAVE_ATTEMPTS
+
+
+def test_save_recreates_a_deleted_session_row(db):
+    _, owner, _ = agent_cli.acquire_session("s", "hi")
+    conn = sqlite3.connect("hotel_agent.db")
+    conn.execute("DELETE FROM sessions WHERE session_id = 's'")
+    conn.commit()
+    conn.close()
+
+    turn = [{"role": "user", "content": "hi"}]
+    agent_cli.save_turn("s", [SYSTEM], 0, owner, turn, "hi", {"text": "re:hi"})
+    assert contents("s") == ["system", "hi"]
+
+
+def create_old_sessions_table():
+    """Schema before session locking: only session_id, context and state."""
+    conn = sqlite3.connect("hotel_agent.db")
+    conn.execute("CREATE TABLE sessions (session_id TEXT PRIMARY KEY, context TEXT, state TEXT)")
+    conn.execute("INSERT INTO sessions VALUES ('old', ?, 'RUNNING')", (json.dumps([SYSTEM]),))
+    conn.commit()
+    conn.close()
+
+
+def test_old_sessions_table_is_migrated(workdir):
+    create_old_sessions_table()
+
+    assert agent_cli.load_session("old") == ([SYSTEM], 0)
+    conn = sqlite3.connect("hotel_agent.db")
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+    conn.close()
+    assert set(agent_cli.SESSION_COLUMNS) <= columns
+    # Legacy RUNNING rows carry no lease, so they do not block the session
+    assert agent_cli.acquire_session("old", "hi")[0] == "ACQUIRED"
+
+
+def test_migration_waits_for_a_concurrent_migration(workdir):
+    create_old_sessions_table()
+
+    # Another process is halfway through the same migration (write lock held)
+    other = sqlite3.connect("hotel_agent.db", isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    for name, sql_type in agent_cli.SESSION_COLUMNS.items():
+        other.execute(f"ALTER TABLE sessions ADD COLUMN {name} {sql_type}")
+    threading.Timer(0.3, other.execute, args=("COMMIT",)).start()
+
+    # Must wait for it and then see the new columns, not fail with "duplicate column"
+    conn = sqlite3.connect("hotel_agent.db", timeout=10, isolation_level=None)
+    agent_cli.ensure_session_columns(conn)
+    conn.close()
+    other.close()
@@ -0,0 +1,263 @@
+# =============================================================================
+# Tests for llm_client.py against local stub OpenAI-compatible servers with
+# injected latency and faults. Run: python -m pytest -q
+# =============================================================================
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+from openai import OpenAI
+
+from llm_client import Endpoint, EndpointStateStore, LLMUnavailableError, ResilientLLMClient
+
+
+class StubServer:
+    """
+    Minimal /v1/chat/completions server. The first fail_first requests get a
+    fail_status error (503 by default); every other request waits delay
+    seconds before answering.
+    """
+
+    def __init__(self, name, delay=0.0, fail_first=0, fail_status=503):
+        self.name = name
+        self.delay = delay
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.requests = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                with stub.lock:
+                    stub.requests += 1
+                    n = stub.requests
+                if n <= stub.fail_first:
+                    self._send(stub.fail_status, {"error": {"message": "injected fault"}})
+                    return
+                time.sleep(stub.delay)
+                self._send(200, {
+                    "id": "stub", "object": "chat.completion", "created": 0, "model": "stub",
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": f"hello from {stub.name}"}}],
+                })
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Client gave up (timeout or lost hedge race)
+                    pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def endpoint(self):
+        client = OpenAI(api_key="test", base_url=self.url, max_retries=0)
+        return Endpoint(self.name, client, "stub-model")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stubs():
+    """Factory for stub servers; all are shut down after the test."""
+    created = []
+
+    def make(name, delay=0.0, fail_first=0, fail_status=503):
+        stub = StubServer(name, delay, fail_first, fail_status)
+        created.append(stub)
+        return stub
+
+    yield make
+    for stub in created:
+        stub.close()
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Breaker/latency store in a throwaway database (never the real hotel_agent.db)."""
+    return EndpointStateStore(str(tmp_path / "state.db"))
+
+
+def reply(completion):
+    return completion.choices[0].message.content
+
+
+def test_retries_transient_errors_then_succeeds(stubs, store):
+    primary = stubs("primary", fail_first=2)
+    client = ResilientLLMClient([primary.endpoint()], backoff_base=0.05, store=store)
+
+    assert reply(client.create(messages=[])) == "hello from primary"
+    assert primary.requests == 3
+
+
+def test_falls_back_on_server_error(stubs, store):
+    primary = stubs("primary", fail_first=1)
+    backup = stubs("backup")
+    client = ResilientLLMClient([primary.endpoint(), backup.endpoint()], store=store)
+
+    assert reply(client.create(messages=[])) == "hello from backup"
+    assert (primary.requests, backup.requests) == (1, 1)
+
+
+def test_falls_back_on_timeout(stubs, store):
+    primary = stubs("primary", delay=5)
+    backup = stubs("backup")
+    client = ResilientLLMClient([primary.endpoint(), backup.endpoint()], attempt_timeout=0.5, store=store)
+
+    start = time.time()
+    assert reply(client.create(messages=[])) == "hello from backup"
+    assert time.time() - start < 2
+
+
+def test_non_transient_error_is_raised_without_retry(stubs, store):
+    primary = stubs("primary", fail_first=1, fail_status=400)
+    backup = stubs("backup")
+    client = ResilientLLMClient([primary.endpoint(), backup.endpoint()], store=store)
+
+    with pytest.raises(openai.BadRequestError):
+        client.create(messages=[])
+    assert (primary.requests, backup.requests) == (1, 0)
+
+
+def test_hedges_slow_primary(stubs, store):
+    primary = stubs("primary", delay=3)
+    backup = stubs("backup")
+    client = ResilientLLMClient([primary.endpoint(), backup.endpoint()], hedge_after=0.2, store=store)
+
+    start = time.time()
+    assert reply(client.create(messages=[])) == "hello from backup"
+    assert time.time() - start < 1.5
+    assert primary.requests == 1
+
+
+def test_failed_hedge_backup_is_not_called_again_in_the_same_round(stubs, store):
+    primary = stubs("primary", delay=2)
+    backup = stubs("backup", fail_first=1000)
+    client = ResilientLLMClient([primary.endpoint(), backup.endpoint()], attempt_timeout=0.5,
+                                max_retries=0, hedge_after=0.1, store=store)
+
+    with pytest.raises(LLMUnavailableError):
+        client.create(messages=[])
+    assert (primary.requests, backup.requests) == (1, 1)
+    assert store.breaker_state("backup")[0] == 1
+
+
+def test_deadline_exhaustion_raises(stubs, store):
+    primary = stubs("primary", delay=5)
+    client = ResilientLLMClient([primary.endpoint()], deadline=1.2, attempt_timeout=0.5,
+                                backoff_base=0.05, store=store)
+
+    start = time.time()
+    with pytest.raises(LLMUnavailableError):
+        client.create(messages=[])
+    assert time.time() - start < 2
+
+
+def test_hedged_call_does_not_delay_process_exit(stubs, store):
+    slow = stubs("slow", delay=10)
+    fast = stubs("fast", delay=0.1)
+    script = textwrap.dedent(f"""
+        from openai import OpenAI
+        from llm_client import Endpoint, EndpointStateStore, ResilientLLMClient
+        endpoints = [
+            Endpoint("slow", OpenAI(api_key="t", base_url="{slow.url}", max_retries=0), "m"),
+            Endpoint("fast", OpenAI(api_key="t", base_url="{fast.url}", max_retries=0), "m"),
+        ]
+        client = ResilientLLMClient(endpoints, hedge_after=0.3, store=EndpointStateStore(r"{store.db_path}"))
+        print(client.create(messages=[]).choices[0].message.content)
+    """)
+    start = time.time()
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                            timeout=30, cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed = time.time() - start
+
+    assert result.stdout.strip() == "hello from fast"
+    # The losing request to the slow stub (10s) must not hold the process open
+    assert elapsed < 5
+
+
+def test_breaker_opens_and_survives_a_new_client(stubs, store):
+    dead = stubs("dead", fail_first=1000)
+    backup = stubs("backup")
+
+    # First "process": three failures on the primary open its circuit
+    client = ResilientLLMClient([dead.endpoint(), backup.endpoint()], max_retries=0, store=store)
+    for _ in range(3):
+        assert reply(client.create(messages=[])) == "hello from backup"
+    assert dead.requests == 3
+
+    # Next "process" (fresh client, same database) skips the dead primary at once
+    client = ResilientLLMClient([dead.endpoint(), backup.endpoint()], max_retries=0, store=store)
+    assert reply(client.create(messages=[])) == "hello from backup"
+    assert dead.requests == 3
+
+
+def test_half_open_fallback_keeps_its_trial_while_primary_answers(stubs, store):
+    primary = stubs("primary")
+    backup = stubs("backup")
+    # Fallback circuit opened long ago: cooldown over, waiting for its trial
+    store.record_failure("backup", failure_threshold=1)
+    conn = store._connect()
+    conn.execute("UPDATE llm_breakers SET opened_at = ? WHERE endpoint = 'backup'", (time.time() - 60,))
+    conn.close()
+    opened_at = store.breaker_state("backup")[1]
+
+    client = ResilientLLMClient([primary.endpoint(), backup.endpoint()], max_retries=0, store=store)
+    assert reply(client.create(messages=[])) == "hello from primary"
+    # Nothing was sent to the fallback, so its trial is still available
+    assert backup.requests == 0
+    assert store.breaker_state("backup")[1] == opened_at
+
+    # Primary starts failing: the fallback gets its trial and closes again
+    primary.fail_first = 1000
+    assert reply(client.create(messages=[])) == "hello from backup"
+    assert store.breaker_state("backup") == (0, None)
+
+
+def test_half_open_breaker_lets_one_trial_through(store):
+    store.record_failure("primary", failure_threshold=1)
+    breaker = ResilientLLMClient([Endpoint("primary", None, "m")], store=store).endpoints[0].breaker
+    assert not breaker.allow()
+
+    # Cooldown over: only the first caller gets the trial request
+    breaker.reset_seconds = 0
+    assert breaker.allow()
+    breaker.reset_seconds = 30
+    assert not breaker.allow()
+
+
+def test_hedge_delay_uses_stored_p95(store):
+    client = ResilientLLMClient([Endpoint("primary", None, "m")], hedge_after=2.0, store=store)
+    endpoint = client.endpoints[0]
+    assert client._hedge_delay(endpoint) == 2.0
+
+    for i in range(1, 21):
+        store.add_latency("primary", i / 10)
+    assert client._hedge_delay(endpoint) == pytest.approx(1.9)
+
+    # 21 samples: 0.95 * 21 = 19.95, so p95 is the 20th smallest
+    store.add_latency("primary", 2.1)
+    assert client._hedge_delay(endpoint) == pytest.approx(2.0)